@@ -1,18 +1,44 @@
 # --- Standard Python Libraries ---
+import asyncio
 import base64
+import hashlib
 import html
+import json
+import math
 import os
+import queue
+import random
+import re
+import signal
+import sqlite3
+import threading
 import time
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from functools import lru_cache
+from email.message import EmailMessage
+from email.policy import SMTP
 
 # --- Third-Party Utility Libraries ---
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter, Retry
+from requests.structures import CaseInsensitiveDict
+
+# orjson serializes JSON several times faster than the stdlib and returns
+# bytes directly; fall back to the stdlib so the bot still runs without it
+try:
+    import orjson
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
 
 # --- Core Application Libraries (Email & AI) ---
 from google import genai
+from google.auth.transport.requests import AuthorizedSession
 from simplegmail import Gmail
 
 # ==============================================================================
@@ -54,226 +80,1071 @@ client = genai.Client(api_key=GOOGLE_API_KEY)
 # Initialize SimpleGmail Client (Requires client_secret.json in root dir)
 gmail = Gmail(client_secret_file='credentials.json')
 
-print("🎧 NovaMail AI (Polling Mode) is listening to your Inbox...")
+# googleapiclient's discovery service is backed by ONE httplib2 connection,
+# which is documented as not thread-safe ("each thread ... must have its own
+# instance of httplib2.Http()"). Concurrent handlers call mark_as_read on
+# worker threads, so every .execute() on the shared service is serialized by
+# this lock. The hot reply path sends through the separate AuthorizedSession,
+# so only the quick list/modify calls (and the rare send fallback) queue here.
+gmail_service_lock = threading.Lock()
 
 # ==============================================================================
-# MAIN POLLING LOOP
+# DIRECT GMAIL SEND PATH (RAW REST)
 # ==============================================================================
-while True:
+# Sending through gmail.service...send().execute() routes every reply through
+# googleapiclient's discovery layer, which rebuilds an httplib2 connection per
+# call. An AuthorizedSession (a requests.Session that injects and auto-
+# refreshes the OAuth bearer token) POSTs straight to the Gmail REST endpoint
+# and keeps the TLS connection alive across replies.
+GMAIL_SEND_URL = "https://gmail.googleapis.com/gmail/v1/users/me/messages/send"
+
+
+def _build_gmail_session():
+    """Wrap simplegmail's OAuth credentials in a persistent AuthorizedSession.
+    Returns None when the credentials cannot be reached (the send path then
+    falls back to the discovery client)."""
     try:
-        # 1. Fetch unread emails
-        unread_messages = gmail.get_unread_messages()
+        creds = getattr(gmail, "creds", None)
+        if creds is None:
+            creds = gmail.service._http.credentials
+        return AuthorizedSession(creds)
+    except Exception:
+        print("⚠️ Warning: Could not build direct Gmail session. Using discovery client for sends.")
+        return None
+
+
+gmail_session = _build_gmail_session()
+
+
+def send_gmail_reply(raw_payload):
+    """Send one raw reply payload, preferring the direct REST session."""
+    if gmail_session is not None:
+        response = gmail_session.post(GMAIL_SEND_URL, json=raw_payload, timeout=10)
+        # Surface API refusals the same way .execute() would (as exceptions)
+        response.raise_for_status()
+    else:
+        # Fallback: the original discovery-client send path (shared httplib2
+        # connection, so hold the service lock)
+        with gmail_service_lock:
+            gmail.service.users().messages().send(userId='me', body=raw_payload).execute()
+
+
+# ==============================================================================
+# TIMEZONE & DATE PARSING FAST PATH
+# ==============================================================================
+# The WIB timezone object used to be rebuilt for every single message; it is a
+# constant, so build it once at module scope. Message dates all share the same
+# ISO 8601 shape, so a precompiled regex extracts the components and constructs
+# the datetime directly, with datetime.fromisoformat kept as the fallback for
+# anything the pattern does not recognize.
+
+# The WIB timezone (UTC+7) for accurate local timestamping
+WIB_TZ = timezone(timedelta(hours=7))
+
+# ISO 8601 date shape: YYYY-MM-DD[T ]HH:MM:SS[.ffffff][+-HH[:MM]]
+DATETIME_RE = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})"
+    r"(?:\.(\d+))?([+-]\d{2}):?(\d{2})?"
+)
+
+
+def parse_email_date(date_str):
+    """Parse an ISO 8601 message date into an aware datetime, or None when
+    the string is unparseable (callers then fall back to the raw value)."""
+    m = DATETIME_RE.match(date_str)
+    if m:
+        # Fractional seconds may be missing or shorter than 6 digits
+        frac = m.group(7)
+        microsecond = int(frac.ljust(6, "0")[:6]) if frac else 0
+
+        # UTC offset: take the sign from the matched text, not the parsed
+        # hour — int("-00") is 0, which would silently flip -00:xx offsets
+        sign = -1 if m.group(8)[0] == "-" else 1
+        tz = timezone(sign * timedelta(
+            hours=int(m.group(8)[1:]), minutes=int(m.group(9) or 0)
+        ))
+
+        return datetime(
+            int(m.group(1)), int(m.group(2)), int(m.group(3)),
+            int(m.group(4)), int(m.group(5)), int(m.group(6)),
+            microsecond, tz,
+        )
+
+    # Slow path: let the stdlib try anything the regex did not match
+    try:
+        return datetime.fromisoformat(date_str)
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=256)
+def fmt_wib(epoch_seconds):
+    """Format an epoch second as a readable WIB timestamp. strftime is slow
+    (locale lookup + C format loop) and messages in a burst often land within
+    the same second, so the LRU cache elides the repeated formatting."""
+    return datetime.fromtimestamp(epoch_seconds, WIB_TZ).strftime("%Y-%m-%d %H:%M:%S WIB")
+
+
+# ==============================================================================
+# GEMINI CONTEXT CACHING (STATIC PROMPT PREAMBLE)
+# ==============================================================================
+# The persona and instruction block (~400 tokens) is identical for every email,
+# yet it used to be re-sent (and re-billed) on every generate_content call.
+# It now lives in a Gemini cachedContent created once per hour; each per-email
+# call only carries the dynamic part (date, sender, subject, body) and points
+# at the cache, cutting input tokens and time-to-first-token per reply.
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# The static preamble: persona plus the fixed instruction list
+PERSONA_INSTRUCTIONS = (
+    "You are an intelligent and highly professional email assistant. "
+    "Your task is to draft a polite, concise, and contextually appropriate reply to the incoming email provided by the user.\n\n"
+    "--- INSTRUCTIONS ---\n"
+    "1. Analyze the 'Message' section. Focus on replying to the newest message at the top, using any quoted text below it purely as context.\n"
+    "2. Acknowledge the sender's latest message gracefully.\n"
+    "3. Provide a clear, relevant, and helpful response based on the context of their message.\n"
+    "4. Maintain a warm yet professional tone.\n"
+    "5. Output ONLY the email body text. Do not include subject lines or conversational filler like 'Here is your draft'."
+)
+
+# Per-email prompt template, built once: the hot loop fills it via format_map,
+# whose substitution runs in C instead of re-executing f-string concatenation
+# bytecode for every message
+PROMPT_TMPL = (
+    "--- EMAIL DETAILS ---\n"
+    "Date Received: {date}\n"
+    "From: {sender}\n"
+    "Subject: {subject}\n"
+    "Message (May include previous conversation history):\n{body}"
+)
+
+# Cap on how much of the email body is sent to Gemini. Long quoted threads
+# inflate input tokens (cost) and time-to-first-token linearly while adding
+# nothing to reply quality; 8 KB is roughly 2k tokens of context.
+GEMINI_BODY_CHAR_LIMIT = 8000
+
+CONTEXT_CACHE_TTL_SECONDS = 3600  # Gemini cachedContent lifetime (1 hour)
+
+# Cache handle shared by the worker threads; refreshed lazily when the TTL lapses
+_context_cache_lock = threading.Lock()
+_context_cache_name = None
+_context_cache_expires_at = 0.0
+
+
+def get_context_cache():
+    """Return the name of a live cachedContent holding the persona block,
+    recreating it shortly before the TTL expires. Returns None when context
+    caching is unavailable (the caller then falls back to the inline prompt)."""
+    global _context_cache_name, _context_cache_expires_at
+
+    with _context_cache_lock:
+        now = time.time()
+        if _context_cache_name and now < _context_cache_expires_at:
+            return _context_cache_name
+
+        try:
+            cache = client.caches.create(
+                model=GEMINI_MODEL,
+                config={
+                    "system_instruction": PERSONA_INSTRUCTIONS,
+                    "ttl": f"{CONTEXT_CACHE_TTL_SECONDS}s",
+                },
+            )
+            _context_cache_name = cache.name
+            # Recreate 60 seconds early so in-flight calls never hit a dead cache
+            _context_cache_expires_at = now + CONTEXT_CACHE_TTL_SECONDS - 60
+        except Exception:
+            # Context caching unsupported or temporarily failing: back off for
+            # 5 minutes instead of retrying on every single email
+            _context_cache_name = None
+            _context_cache_expires_at = now + 300
+
+        return _context_cache_name
+
+
+# ==============================================================================
+# BATCHED UNREAD MESSAGE FETCHING
+# ==============================================================================
+# simplegmail's get_unread_messages() issues one messages.get HTTPS round trip
+# PER message on top of the initial messages.list (N+1 calls per poll cycle).
+# We instead list the unread IDs once and pull the full bodies through the
+# Gmail API's BatchHttpRequest, which packs up to 100 gets into a single HTTP
+# call. The results are wrapped in a small dataclass that mirrors the subset
+# of simplegmail's Message API the rest of the loop relies on, so downstream
+# code is unchanged.
+
+# Gmail caps batch requests at 100 inner calls
+BATCH_FETCH_SIZE = 100
+
+# Server-side search filter for the messages.list call. Promotional/social
+# mail and obvious no-reply senders would be discarded by should_reply()
+# anyway, and anything older than a day predates this bot run — filtering in
+# Gmail's search index means those messages are never listed, fetched, or
+# batched in the first place (zero client CPU and smaller batch gets).
+UNREAD_QUERY = "is:unread -category:promotions -category:social -from:noreply newer_than:1d"
+
+
+@dataclass
+class InboxMessage:
+    """Lightweight stand-in for simplegmail's Message, built from a raw
+    Gmail API messages.get response."""
+    id: str
+    thread_id: str
+    sender: str
+    subject: str
+    date: str
+    plain: str
+    headers: dict = field(default_factory=dict)
+    label_ids: list = field(default_factory=list)
+
+    def mark_as_read(self):
+        """Remove the UNREAD label so the message is not processed again."""
+        # Runs on concurrent worker threads: serialize use of the shared
+        # (non-thread-safe) discovery connection
+        with gmail_service_lock:
+            gmail.service.users().messages().modify(
+                userId='me',
+                id=self.id,
+                body={"removeLabelIds": ["UNREAD"]}
+            ).execute()
+
+
+def _extract_plain_body(payload):
+    """Walk the MIME payload tree and return the first text/plain part,
+    base64url-decoded. Returns an empty string for HTML-only emails."""
+    if payload.get("mimeType") == "text/plain":
+        data = payload.get("body", {}).get("data")
+        if data:
+            return base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
+
+    # Multipart emails nest the real body inside 'parts'; recurse until found
+    for part in payload.get("parts", []):
+        body = _extract_plain_body(part)
+        if body:
+            return body
+
+    return ""
+
+
+def _build_inbox_message(raw_msg):
+    """Convert a raw messages.get response into an InboxMessage."""
+    payload = raw_msg.get("payload", {})
+
+    # Flatten the list of {name, value} header dicts into a plain dict
+    headers = {h["name"]: h["value"] for h in payload.get("headers", [])}
+
+    # internalDate is epoch milliseconds; render it as an ISO 8601 string so
+    # the existing datetime.fromisoformat() parsing keeps working unchanged
+    internal_ms = raw_msg.get("internalDate")
+    if internal_ms:
+        date_str = datetime.fromtimestamp(
+            int(internal_ms) / 1000, tz=timezone.utc
+        ).isoformat()
+    else:
+        date_str = headers.get("Date", "")
 
-        if not unread_messages:
-            print("📭 Inbox is clean. (Checking again in 30 seconds)")
+    return InboxMessage(
+        id=raw_msg["id"],
+        thread_id=raw_msg.get("threadId", ""),
+        sender=headers.get("From", ""),
+        subject=headers.get("Subject", ""),
+        date=date_str,
+        plain=_extract_plain_body(payload),
+        headers=headers,
+        label_ids=raw_msg.get("labelIds", []),
+    )
+
+
+def fetch_unread_messages():
+    """Fetch recent, reply-worthy unread inbox messages using one filtered
+    messages.list call plus one batched messages.get per 100 messages
+    (instead of N single gets)."""
+    # Follow nextPageToken so a backlog larger than one page (100 IDs by
+    # default) is not silently capped per poll cycle
+    refs = []
+    page_token = None
+    while True:
+        with gmail_service_lock:
+            listing = gmail.service.users().messages().list(
+                userId='me', q=UNREAD_QUERY, labelIds=['INBOX'],
+                maxResults=BATCH_FETCH_SIZE, pageToken=page_token
+            ).execute()
+        refs.extend(listing.get("messages", []))
+        page_token = listing.get("nextPageToken")
+        if not page_token:
+            break
+
+    if not refs:
+        return []
+
+    messages = []
+
+    # Batch callback: collect successful responses, log (but tolerate) errors
+    def collect(request_id, response, exception):
+        if exception is not None:
+            print(f"⚠️ Warning: Failed to fetch message in batch -> {request_id}")
         else:
-            # 2. Process each unread email
-            for msg in unread_messages:
-                # Define the WIB timezone (UTC+7) for accurate local timestamping
-                wib_tz = timezone(timedelta(hours=7))
-                
-                try:
-                    # Parse the ISO 8601 formatted date string provided by simplegmail into a datetime object.
-                    # Wrapping in str() acts as a defensive safeguard against unexpected data types.
-                    parsed_email_date = datetime.fromisoformat(str(msg.date))
-                    
-                    # Convert the timezone-aware date to the WIB timezone and apply a consistent readable format
-                    received_time_wib = parsed_email_date.astimezone(wib_tz).strftime("%Y-%m-%d %H:%M:%S WIB")
-                except Exception as e:
-                    # Fallback to the raw string value to ensure the application continues running if parsing fails
-                    received_time_wib = str(msg.date)
-
-                # --- PREPARE TERMINAL PREVIEW ---
-                # DEFENSIVE PROGRAMMING: Ensure msg.plain is not None to prevent TypeError
-                safe_body = msg.plain if msg.plain else "(No plain text body. Email might be HTML only.)"
-
-                # Create a concise 100-character snippet for terminal logging
-                body_preview = f"{safe_body[:100]}..." if len(safe_body) > 100 else safe_body
-
-                print("\n==================================================")
-                print(f"📩 NEW EMAIL DETECTED!")
-                print(f"🕒 Date   : {received_time_wib}")
-                print(f"👤 From   : {msg.sender}")
-                print(f"📌 Subject: {msg.subject}")
-                print(f"💬 Body   : {body_preview}") # Print first 100 chars for context
-                print("==================================================")
-
-                # 3. Generate Reply using Gemini AI
-                # Enhanced prompt to give the AI a clear persona, context, and strict instructions
-                ai_prompt = (
-                    f"You are an intelligent and highly professional email assistant. "
-                    f"Your task is to draft a polite, concise, and contextually appropriate reply to the following incoming email.\n\n"
-                    f"--- EMAIL DETAILS ---\n"
-                    f"Date Received: {received_time_wib}\n"
-                    f"From: {msg.sender}\n"
-                    f"Subject: {msg.subject}\n"
-                    f"Message (May include previous conversation history):\n{msg.plain}\n\n"
-                    f"--- INSTRUCTIONS ---\n"
-                    f"1. Analyze the 'Message' section. Focus on replying to the newest message at the top, using any quoted text below it purely as context.\n"
-                    f"2. Acknowledge the sender's latest message gracefully.\n"
-                    f"3. Provide a clear, relevant, and helpful response based on the context of their message.\n"
-                    f"4. Maintain a warm yet professional tone.\n"
-                    f"5. Output ONLY the email body text. Do not include subject lines or conversational filler like 'Here is your draft'."
-                )
-
-                print("🤖 Gemini is thinking...")
-                
-                # SECURE AI INVOCATION: Wrapped in try-except to prevent API crashes
-                try:
-                    model_response = client.models.generate_content(
-                        model="gemini-2.5-flash",
-                        contents=ai_prompt
-                    )
+            messages.append(_build_inbox_message(response))
 
-                    # 4. Validate AI Output
-                    if model_response.text and len(model_response.text.strip()) > 0:
-                        reply_text = model_response.text.strip()
-                    else:
-                        reply_text = "Apologies, I received your email but the AI failed to generate a response at this time."
-
-                except Exception as ai_error:
-                    # SECURE ERROR HANDLING: Sanitize output to prevent API Key leakage
-                    error_str = str(ai_error).lower()
-                    if "quota" in error_str or "429" in error_str:
-                        print("❌ AI Error: API Quota exceeded or Rate Limited.")
-                    elif "api_key" in error_str or "403" in error_str:
-                        print("❌ AI Error: API Key is invalid or expired.")
-                    else:
-                        print("❌ AI Error: Failed to generate content due to an unknown API issue.")
-                    
-                    # Fallback text so the bot can still reply and move past the broken email
-                    reply_text = "System Notice: The AI assistant is currently unavailable to process this request. We will get back to you manually."
-
-                # 5. Send Reply & Update Email Status
-                # Ensure the reply subject follows standard email thread conventions (adding "Re:" if not present)
-                reply_subject = msg.subject if msg.subject.startswith("Re:") else f"Re: {msg.subject}"
-
-                # Construct the MIME message container to build a compliant RFC 2822 email structure
-                mime_msg = MIMEMultipart()
-                mime_msg["to"] = msg.sender
-                mime_msg["from"] = "me"
-                mime_msg["subject"] = reply_subject
-
-                # Retrieve the original Message-ID from headers to maintain thread integrity
-                # We check both standard and lowercase keys for maximum compatibility
-                original_message_id = (
-                    msg.headers.get("Message-ID") or 
-                    msg.headers.get("message-id")
-                )
-
-                # Fetch existing references to track the entire conversation history
-                references = (
-                    msg.headers.get("References") or
-                    msg.headers.get("references")
-                )
-
-                # Inject threading headers to ensure Gmail and other clients group the reply correctly
-                if original_message_id:
-                    # In-Reply-To links this specific reply to the parent message
-                    mime_msg["In-Reply-To"] = original_message_id
-
-                    # References maintains the chain of all previous Message-IDs in the conversation
-                    if references:
-                        # Append the current message ID to the existing reference chain
-                        mime_msg["References"] = references + " " + original_message_id
-                    else:
-                        # Start a new reference chain if none exists
-                        mime_msg["References"] = original_message_id
-
-                # Attach the AI-generated reply body as HTML for rich text rendering
-                mime_msg.attach(MIMEText(reply_text.replace("\n", "<br>"), "html", "utf-8"))
-
-                # Encode the entire MIME structure into a URL-safe Base64 string for Gmail API compatibility
-                raw_string = base64.urlsafe_b64encode(mime_msg.as_bytes()).decode()
-
-                # Prepare the API payload consisting of the encoded raw message and the existing threadId
-                raw_payload = {
-                    "raw": raw_string,
-                    "threadId": msg.thread_id
-                }
-                
-                # Dispatch the reply directly through the official Google Gmail API service layer
-                gmail.service.users().messages().send(userId='me', body=raw_payload).execute()
-                
-                # Mark the original message as read to signify successful processing
-                msg.mark_as_read()
-                print("✅ Email successfully replied and marked as READ.")
-
-                # ==============================================================================
-                # TELEGRAM NOTIFICATION SYSTEM
-                # ==============================================================================
-                if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
-                    print("⚠️ Warning: Telegram credentials are missing. Skipping notification.")
-                    continue
-
-                # Fetch the current exact time in WIB for the AI reply timestamp
-                current_time = datetime.now(wib_tz).strftime("%Y-%m-%d %H:%M:%S WIB")
-
-                # Create a more detailed 500-character snippet for the Telegram report
-                # This ensures the report stays within Telegram's 4096 character limit
-                body_preview = f"{safe_body[:500]}..." if len(safe_body) > 500 else safe_body
-
-                # Sanitize dynamic content to prevent Telegram API parsing errors (e.g., Error 400).
-                # This safely escapes special characters like <, >, and & within the email body.
-                safe_sender = html.escape(msg.sender)
-                safe_subject = html.escape(msg.subject)
-                safe_body_escaped = html.escape(body_preview)
-                safe_reply_escaped = html.escape(reply_text)
-
-                # Prepare a well-formatted HTML report for Telegram.
-                # Truncating the original message body to 500 chars to avoid Telegram's 4096 character limit.
-                telegram_report = (
-                    f"🚨 <b>NOVAMAIL AI REPORT</b> 🚨\n\n"
-                    f"🕒 <b>Received:</b> <code>{received_time_wib}</code>\n"
-                    f"👤 <b>From:</b> <code>{safe_sender}</code>\n"
-                    f"📌 <b>Subject:</b> {safe_subject}\n\n"
-                    f"💬 <b>Original Message:</b>\n{safe_body_escaped}\n\n"
-                    f"🤖 <b>AI Reply Sent:</b>\n<i>{safe_reply_escaped}</i>\n\n"
-                    f"⏱️ <b>Replied At:</b> <code>{current_time}</code>"
-                )
-
-                url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-                data = {
-                    "chat_id": TELEGRAM_CHAT_ID,
-                    "text": telegram_report,
-                    "parse_mode": "HTML" 
-                }
-
-                try:
-                    # Send POST request to Telegram API
-                    response = requests.post(url, json=data)
-                    
-                    # Check HTTP Status Code (200 = OK)
-                    if response.status_code == 200:
-                        print("📱 Success: Notification sent to Telegram!")
-                    else:
-                        # Log the specific error from Telegram for debugging safely
-                        print(f"❌ Telegram API Refused: Status Code {response.status_code}")
-                        print(f"⚠️ Telegram Error Detail: {response.text}")
-                        
-                except Exception as e:
-                    # Safely handle network errors without leaking sensitive URLs
-                    error_str = str(e).lower()
-
-                    if "connection" in error_str or "dns" in error_str:
-                        print("❌ Network Error: Failed to connect to Telegram API.")
-                    elif "timeout" in error_str:
-                        print("⏳ Timeout Error: Telegram API did not respond.")
-                    elif "ssl" in error_str:
-                        print("🔒 SSL Error: Certificate verification failed.")
-                    else:
-                        print("❌ Telegram Send Failed: Unknown network error occurred.")
+    # Chunk the ID list into groups of 100 (the Gmail batch ceiling)
+    for start in range(0, len(refs), BATCH_FETCH_SIZE):
+        batch = gmail.service.new_batch_http_request()
+        for ref in refs[start:start + BATCH_FETCH_SIZE]:
+            batch.add(
+                gmail.service.users().messages().get(
+                    userId='me', id=ref["id"], format='full'
+                ),
+                callback=collect,
+            )
+        with gmail_service_lock:
+            batch.execute()
+
+    return messages
+
+
+def dedupe_by_thread(unread_messages):
+    """Collapse a burst of unread messages to one per conversation thread.
+
+    Back-and-forth conversations often land 2-3 unreads in the same thread in
+    a single poll cycle; replying to each one means redundant Gemini calls and
+    a confusing pile of replies. Returns (newest, superseded): the newest
+    message per thread_id — whose body already quotes the older ones as
+    context — and the older siblings to be marked read without a reply."""
+    by_thread = {}
+    superseded = []
+
+    # Sorting by date makes the last write per thread the newest message
+    for m in sorted(unread_messages, key=lambda m: m.date):
+        if m.thread_id in by_thread:
+            superseded.append(by_thread[m.thread_id])
+        by_thread[m.thread_id] = m
+
+    return list(by_thread.values()), superseded
+
+
+def mark_superseded_as_read(msg):
+    """Clear the unread flag on an older per-thread message (no AI reply)."""
+    msg.mark_as_read()
+    print("🧹 Older message in an active thread marked as READ (reply goes to the newest one).")
+
+
+# ==============================================================================
+# CRASH-SAFE IDEMPOTENCY STATE
+# ==============================================================================
+# If the bot crashes (or is redeployed) after sending a reply but before
+# mark_as_read() goes through, the next poll cycle picks the same message up
+# again and would send a duplicate reply. Every processed message ID is
+# recorded in a local SQLite table the moment its handler starts; the
+# INSERT OR IGNORE makes the claim atomic, so a restarted bot — or a racing
+# worker thread — skips IDs that were already claimed.
+STATE_DB_PATH = "state.db"
+
+state_lock = threading.Lock()
+state_conn = sqlite3.connect(STATE_DB_PATH, check_same_thread=False)
+state_conn.execute(
+    "CREATE TABLE IF NOT EXISTS seen ("
+    "  id TEXT PRIMARY KEY,"
+    "  ts INTEGER"
+    ")"
+)
+state_conn.commit()
+
+
+def claim_message(message_id):
+    """Atomically claim a message ID for processing. Returns False when the
+    ID was already claimed (a previous run or worker handled it)."""
+    with state_lock:
+        cursor = state_conn.execute(
+            "INSERT OR IGNORE INTO seen VALUES (?, ?)",
+            (message_id, int(time.time())),
+        )
+        state_conn.commit()
+        return cursor.rowcount == 1
+
+
+def release_claim(message_id):
+    """Drop the claim on a message whose processing failed before the reply
+    went out, so the next poll cycle retries it instead of dropping it."""
+    with state_lock:
+        state_conn.execute("DELETE FROM seen WHERE id = ?", (message_id,))
+        state_conn.commit()
+
+
+# ==============================================================================
+# SEMANTIC REPLY CACHE
+# ==============================================================================
+# Near-duplicate emails ("thanks", "ok got it", recurring reminders) used to
+# trigger a full Gemini round trip every single time. Replies are now cached
+# in a local SQLite database with two lookup layers:
+#   L1: exact match on a SHA-256 hash of the stripped body (free, no API call)
+#   L2: cosine similarity between text-embedding-004 vectors (one cheap
+#       embedding call instead of a full generate_content invocation)
+# Entries are namespaced per sender to avoid cross-contamination between
+# conversations and expire after 24 hours.
+CACHE_DB_PATH = "cache.db"
+CACHE_TTL_SECONDS = 24 * 3600      # Cached replies go stale after one day
+CACHE_SIMILARITY_THRESHOLD = 0.92  # Minimum cosine similarity for an L2 hit
+EMBEDDING_MODEL = "text-embedding-004"
+
+# SQLite connections are not thread-safe by default; the worker threads share
+# one connection guarded by a lock (cache operations are microsecond-scale)
+cache_lock = threading.Lock()
+cache_conn = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+cache_conn.execute(
+    "CREATE TABLE IF NOT EXISTS reply_cache ("
+    "  sender     TEXT,"
+    "  body_hash  TEXT,"
+    "  embedding  TEXT,"
+    "  reply_text TEXT,"
+    "  ts         INTEGER"
+    ")"
+)
+cache_conn.execute(
+    "CREATE INDEX IF NOT EXISTS idx_reply_cache_sender ON reply_cache(sender)"
+)
+cache_conn.commit()
+
+
+def _body_hash(body):
+    """Stable fingerprint of the email body for the exact-match (L1) layer."""
+    return hashlib.sha256(body.strip().lower().encode("utf-8")).hexdigest()
+
+
+def _cosine_similarity(a, b):
+    """Cosine similarity between two embedding vectors (pure Python; the
+    per-sender candidate set is small enough that no vector index is needed)."""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = math.sqrt(sum(x * x for x in a))
+    norm_b = math.sqrt(sum(x * x for x in b))
+    if norm_a == 0 or norm_b == 0:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+
+def _embed_body(body):
+    """Compute the embedding vector for an email body (capped at 2000 chars)."""
+    result = client.models.embed_content(
+        model=EMBEDDING_MODEL,
+        contents=body[:2000],
+    )
+    return list(result.embeddings[0].values)
+
+
+def lookup_cached_reply(sender, body):
+    """Return (cached_reply, embedding) for this email.
+
+    cached_reply is None on a miss; embedding is the freshly computed vector
+    (so a following store does not pay for a second embedding call), or None
+    when only the L1 layer was consulted or the embedding call failed."""
+    now = int(time.time())
+    cutoff = now - CACHE_TTL_SECONDS
+
+    # L1: exact body hash match — costs nothing, catches true duplicates
+    with cache_lock:
+        row = cache_conn.execute(
+            "SELECT reply_text FROM reply_cache"
+            " WHERE sender = ? AND body_hash = ? AND ts > ?"
+            " ORDER BY ts DESC LIMIT 1",
+            (sender, _body_hash(body), cutoff),
+        ).fetchone()
+    if row:
+        return row[0], None
+
+    # L2: semantic match — one embedding call, then cosine against the
+    # sender's recent entries
+    try:
+        embedding = _embed_body(body)
+    except Exception:
+        # Embedding API hiccup: skip the cache rather than break the reply path
+        return None, None
+
+    with cache_lock:
+        rows = cache_conn.execute(
+            "SELECT embedding, reply_text FROM reply_cache"
+            " WHERE sender = ? AND ts > ?",
+            (sender, cutoff),
+        ).fetchall()
+
+    best_sim, best_reply = 0.0, None
+    for stored_embedding, reply_text in rows:
+        sim = _cosine_similarity(embedding, json.loads(stored_embedding))
+        if sim > best_sim:
+            best_sim, best_reply = sim, reply_text
+
+    if best_sim >= CACHE_SIMILARITY_THRESHOLD:
+        return best_reply, embedding
+    return None, embedding
+
+
+def store_cached_reply(sender, body, embedding, reply_text):
+    """Persist a freshly generated reply (and prune this sender's expired rows)."""
+    if embedding is None:
+        return
+    now = int(time.time())
+    with cache_lock:
+        cache_conn.execute(
+            "DELETE FROM reply_cache WHERE sender = ? AND ts <= ?",
+            (sender, now - CACHE_TTL_SECONDS),
+        )
+        cache_conn.execute(
+            "INSERT INTO reply_cache VALUES (?, ?, ?, ?, ?)",
+            (sender, _body_hash(body), json.dumps(embedding), reply_text, now),
+        )
+        cache_conn.commit()
+
+
+# ==============================================================================
+# CONCURRENT PER-EMAIL PROCESSING (ASYNCIO)
+# ==============================================================================
+# Every step of handling one email blocks on the network, so a burst of K
+# unreads used to take K x (sum of all latencies) when processed serially.
+# Each batch now runs on an asyncio event loop: Gemini calls go through the
+# genai client's native async path (client.aio), which multiplexes concurrent
+# requests over one HTTP/2 connection instead of paying per-request TLS setup,
+# while the blocking Gmail/SQLite helpers are pushed onto worker threads with
+# asyncio.to_thread. A semaphore caps in-flight Gemini calls to respect QPS.
+GEMINI_MAX_CONCURRENCY = 4
+
+# Serialize multi-line terminal output so concurrent workers do not interleave
+print_lock = threading.Lock()
+
+# Translation table that HTML-escapes the reply body AND converts newlines to
+# <br> in one C-level pass over the string, instead of separate html.escape
+# and join/replace passes that each allocate an intermediate copy
+HTML_BODY_TBL = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    "\n": "<br>",
+})
+
+# ==============================================================================
+# PERSISTENT TELEGRAM HTTP SESSION
+# ==============================================================================
+# A bare requests.post() opens a fresh TCP+TLS connection to api.telegram.org
+# on every notification (~2 round trips of pure handshake overhead). One shared
+# Session with a pooled adapter keeps persistent connections alive across all
+# worker threads and transparently retries transient Telegram-side failures.
+telegram_session = requests.Session()
+telegram_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,  # Matches the thread pool size so no worker waits
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+        ),
+    ),
+)
+
+# The endpoint never changes at runtime, so build the URL once at startup
+TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+
+# Connect / read timeouts so a hung Telegram API cannot stall a worker forever
+TELEGRAM_TIMEOUT = (3.05, 10)
+
+# Payloads are serialized up front (see _json_dumps), so the content type must
+# be declared explicitly — requests only sets it for the json= keyword
+TELEGRAM_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# ==============================================================================
+# BACKGROUND TELEGRAM NOTIFICATION QUEUE
+# ==============================================================================
+# The Telegram POST is a side channel: nothing downstream depends on it, yet it
+# used to run inline and could hold a worker hostage for up to 10 seconds when
+# Telegram was slow. Reports are now dropped onto a bounded queue and a single
+# daemon thread drains it, so email handlers enqueue and immediately move on.
+# The bounded size plus drop-on-full policy keeps memory flat during outages.
+notify_queue = queue.Queue(maxsize=1000)
+
+
+def send_telegram_report(telegram_report):
+    """POST one report to Telegram over the shared session (worker thread only)."""
+    # Serialize the payload to bytes once via orjson instead of letting
+    # requests run stdlib json.dumps() inside every post(json=...) call
+    body = _json_dumps({
+        "chat_id": TELEGRAM_CHAT_ID,
+        "text": telegram_report,
+        "parse_mode": "HTML"
+    })
+
+    try:
+        # Send POST request to Telegram API over the shared pooled session
+        response = telegram_session.post(
+            TELEGRAM_URL, data=body, headers=TELEGRAM_JSON_HEADERS, timeout=TELEGRAM_TIMEOUT
+        )
+
+        # Check HTTP Status Code (200 = OK)
+        if response.status_code == 200:
+            print("📱 Success: Notification sent to Telegram!")
+        else:
+            # Log the specific error from Telegram for debugging safely
+            print(f"❌ Telegram API Refused: Status Code {response.status_code}")
+            print(f"⚠️ Telegram Error Detail: {response.text}")
+
+    except Exception as e:
+        # Safely handle network errors without leaking sensitive URLs
+        error_str = str(e).lower()
+
+        if "connection" in error_str or "dns" in error_str:
+            print("❌ Network Error: Failed to connect to Telegram API.")
+        elif "timeout" in error_str:
+            print("⏳ Timeout Error: Telegram API did not respond.")
+        elif "ssl" in error_str:
+            print("🔒 SSL Error: Certificate verification failed.")
+        else:
+            print("❌ Telegram Send Failed: Unknown network error occurred.")
+
+
+# During a burst of K unread emails, K separate sendMessage POSTs cost K TLS
+# round trips. The worker instead coalesces reports that arrive close together
+# into one concatenated message, staying well under Telegram's 4096-char cap.
+# The batch threshold adapts to the inbound rate: it doubles (up to 16) while
+# bursts keep filling batches and snaps back to 2 during quiet periods.
+NOTIFY_BATCH_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+NOTIFY_BATCH_MIN = 2          # Starting batch-size threshold
+NOTIFY_BATCH_MAX = 16         # Ceiling for the adaptive threshold
+NOTIFY_FLUSH_AGE_SECONDS = 2  # Never hold a report longer than this
+NOTIFY_FLUSH_CHAR_LIMIT = 3500  # Headroom below Telegram's 4096-char limit
+
+
+def telegram_worker():
+    """Drain the notification queue forever, coalescing bursts into one POST."""
+    batch_threshold = NOTIFY_BATCH_MIN
+    carried_over = None  # Report that did not fit in the previous batch
+
+    while True:
+        # Block until the first report of the next batch is available
+        if carried_over is not None:
+            batch = [carried_over]
+            carried_over = None
+        else:
+            batch = [notify_queue.get()]
+            notify_queue.task_done()
+
+        total_chars = len(batch[0])
+        deadline = time.monotonic() + NOTIFY_FLUSH_AGE_SECONDS
+
+        # Keep collecting until the threshold, the age window, or the char
+        # budget is hit — whichever comes first
+        while len(batch) < batch_threshold and total_chars < NOTIFY_FLUSH_CHAR_LIMIT:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                report = notify_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            notify_queue.task_done()
+
+            if total_chars + len(report) > NOTIFY_FLUSH_CHAR_LIMIT:
+                # Would overflow the Telegram limit: start the next batch with it
+                carried_over = report
+                break
+            batch.append(report)
+            total_chars += len(report) + len(NOTIFY_BATCH_SEPARATOR)
+
+        # Adapt the threshold to the inbound rate: a full batch means a burst
+        # is in progress (double up), a lone report means quiet (reset)
+        if len(batch) >= batch_threshold:
+            batch_threshold = min(batch_threshold * 2, NOTIFY_BATCH_MAX)
+        elif len(batch) == 1:
+            batch_threshold = NOTIFY_BATCH_MIN
+
+        send_telegram_report(NOTIFY_BATCH_SEPARATOR.join(batch))
+
+
+# Daemon thread: dies with the process, never blocks shutdown
+threading.Thread(target=telegram_worker, daemon=True).start()
+
+
+# ==============================================================================
+# REPLY ELIGIBILITY FILTER
+# ==============================================================================
+# Not every unread message deserves an LLM reply: bounces, OTP codes,
+# unsubscribe confirmations, out-of-office autoresponders, and spam/promo mail
+# should just be marked as read. These cheap structural checks run before the
+# Gemini call — the dominant cost in the loop — so each skipped email saves a
+# full generate_content round trip.
+
+# Senders that are machines, not people (bounces, notification firehoses)
+NO_REPLY_SENDER_RE = re.compile(
+    r"no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer-daemon|postmaster@", re.IGNORECASE
+)
+
+# Subjects that signal automated transactional mail
+AUTOMATED_SUBJECT_RE = re.compile(
+    r"^\s*(otp|verification|security alert|out of office|automatic reply)",
+    re.IGNORECASE,
+)
+
+# Gmail labels that disqualify a message from an AI reply
+SKIP_LABELS = frozenset({"SPAM", "CATEGORY_PROMOTIONS"})
+
+
+def should_reply(msg):
+    """Return True when this email warrants an AI-generated reply."""
+    # Machine senders never read replies
+    if NO_REPLY_SENDER_RE.search(msg.sender or ""):
+        return False
+
+    # Headers arrive with arbitrary capitalization; one case-insensitive view
+    # replaces the per-variant lookup chains
+    headers = CaseInsensitiveDict(msg.headers)
+
+    # RFC 3834: anything auto-submitted (bounces, vacation replies) is skipped
+    auto_submitted = headers.get("Auto-Submitted")
+    if auto_submitted and auto_submitted.lower() != "no":
+        return False
+
+    # Bulk mail with an unsubscribe header is a broadcast, not a conversation
+    if headers.get("List-Unsubscribe"):
+        return False
+
+    # Transactional subjects (OTP codes, security alerts, OOO autoresponders)
+    if AUTOMATED_SUBJECT_RE.match(msg.subject or ""):
+        return False
+
+    # Respect Gmail's own spam / promotions classification
+    if SKIP_LABELS.intersection(msg.label_ids):
+        return False
+
+    return True
+
+
+async def handle_message(msg, gemini_semaphore):
+    """Process one unread email end-to-end: log it, generate an AI reply,
+    send the reply in-thread, mark it read, and report to Telegram."""
+    # IDEMPOTENCY GUARD: Claim the message ID before doing anything. A
+    # duplicate claim means a previous run already replied but crashed before
+    # clearing the unread flag — clear it now, but never send a second reply.
+    # The blocking SQLite insert+commit runs on a worker thread like the
+    # other state helpers, so a slow disk cannot stall the event loop.
+    if not await asyncio.to_thread(claim_message, msg.id):
+        await asyncio.to_thread(msg.mark_as_read)
+        print(f"🔁 Already processed message {msg.id} in a previous run (marked as READ, no duplicate reply).")
+        return
+
+    # FILTER FIRST: Skip the expensive Gemini + reply path entirely for
+    # automated mail; just clear the unread flag so it is not seen again
+    if not should_reply(msg):
+        await asyncio.to_thread(msg.mark_as_read)
+        print(f"🚫 Skipped automated email from {msg.sender} (marked as READ, no AI reply).")
+        return
+
+    # Everything past this point can fail transiently (Gemini, the Gmail
+    # send, mark_as_read). Until the reply has actually gone out, a failure
+    # must release the claim so the next poll cycle retries this message;
+    # after the send, the claim is kept to prevent a duplicate reply.
+    reply_sent = False
+    try:
+        # Parse the ISO 8601 date via the precompiled regex fast path.
+        # Wrapping in str() acts as a defensive safeguard against unexpected data types.
+        parsed_email_date = parse_email_date(str(msg.date))
 
-    except Exception as general_error:
-        # SECURE ERROR HANDLING: Do NOT print raw 'general_error' to avoid credential leaks.
-        error_str = str(general_error).lower()
-        if "credentials" in error_str or "token" in error_str:
-            print("🚨 System Error: Authentication failed. Check your token.json or credentials.")
+        if parsed_email_date is not None:
+            # Render the timestamp through the memoized WIB formatter (same-second
+            # messages in a burst reuse the cached string)
+            received_time_wib = fmt_wib(int(parsed_email_date.timestamp()))
         else:
-            print(f"🚨 An unexpected system error occurred. Waiting for the next polling cycle to retry -> {error_str}.")
+            # Fallback to the raw string value to ensure the application continues running if parsing fails
+            received_time_wib = str(msg.date)
+
+        # --- PREPARE BODY VARIANTS (TRUNCATE ONCE, REUSE EVERYWHERE) ---
+        # DEFENSIVE PROGRAMMING: Ensure msg.plain is not None to prevent TypeError
+        body_full = msg.plain if msg.plain else "(No plain text body. Email might be HTML only.)"
+
+        # One capped slice feeds the Gemini prompt, the reply cache, and both
+        # previews below, instead of three independent substring operations
+        body_cap = body_full[:GEMINI_BODY_CHAR_LIMIT]
+
+        # Create a concise 100-character snippet for terminal logging
+        body_preview = f"{body_cap[:100]}..." if len(body_full) > 100 else body_cap
+
+        # Hold the print lock so concurrent workers do not interleave the banner
+        with print_lock:
+            print("\n==================================================")
+            print(f"📩 NEW EMAIL DETECTED!")
+            print(f"🕒 Date   : {received_time_wib}")
+            print(f"👤 From   : {msg.sender}")
+            print(f"📌 Subject: {msg.subject}")
+            print(f"💬 Body   : {body_preview}") # Print first 100 chars for context
+            print("==================================================")
+
+        # 3. Generate Reply using Gemini AI
+        # Only the email-specific details travel with each call; the persona and
+        # instruction block is served from the hourly Gemini context cache
+        ai_prompt = PROMPT_TMPL.format_map({
+            "date": received_time_wib,
+            "sender": msg.sender,
+            "subject": msg.subject,
+            "body": body_cap,
+        })
+
+        # CACHE LOOKUP: Serve near-duplicate emails from the local reply cache
+        # (exact hash first, then embedding similarity) to skip the Gemini call
+        cached_reply, query_embedding = await asyncio.to_thread(
+            lookup_cached_reply, msg.sender, body_cap
+        )
+        if cached_reply is not None:
+            print("⚡ Cache hit: Reusing a recent reply for this near-duplicate email.")
+            reply_text = cached_reply
+        else:
+            print("🤖 Gemini is thinking...")
+
+            # SECURE AI INVOCATION: Wrapped in try-except to prevent API crashes
+            try:
+                cache_name = await asyncio.to_thread(get_context_cache)
+
+                # The semaphore bounds in-flight Gemini calls; client.aio
+                # multiplexes them over one shared HTTP/2 connection
+                async with gemini_semaphore:
+                    if cache_name:
+                        # Static preamble comes from the context cache; send only
+                        # the dynamic email details
+                        model_response = await client.aio.models.generate_content(
+                            model=GEMINI_MODEL,
+                            contents=ai_prompt,
+                            config={"cached_content": cache_name}
+                        )
+                    else:
+                        # Context caching unavailable: fall back to the full inline prompt
+                        model_response = await client.aio.models.generate_content(
+                            model=GEMINI_MODEL,
+                            contents=f"{PERSONA_INSTRUCTIONS}\n\n{ai_prompt}"
+                        )
+
+                # 4. Validate AI Output
+                if model_response.text and len(model_response.text.strip()) > 0:
+                    reply_text = model_response.text.strip()
+
+                    # Persist the genuine AI reply so future near-duplicates hit
+                    # the cache; the SQLite write (commit = fsync) goes to a
+                    # worker thread like the lookup so it cannot stall the loop
+                    await asyncio.to_thread(
+                        store_cached_reply, msg.sender, body_cap, query_embedding, reply_text
+                    )
+                else:
+                    reply_text = "Apologies, I received your email but the AI failed to generate a response at this time."
+
+            except Exception as ai_error:
+                # SECURE ERROR HANDLING: Sanitize output to prevent API Key leakage
+                error_str = str(ai_error).lower()
+                if "quota" in error_str or "429" in error_str:
+                    print("❌ AI Error: API Quota exceeded or Rate Limited.")
+                elif "api_key" in error_str or "403" in error_str:
+                    print("❌ AI Error: API Key is invalid or expired.")
+                else:
+                    print("❌ AI Error: Failed to generate content due to an unknown API issue.")
+
+                # Fallback text so the bot can still reply and move past the broken email
+                reply_text = "System Notice: The AI assistant is currently unavailable to process this request. We will get back to you manually."
+
+        # 5. Send Reply & Update Email Status
+        # Ensure the reply subject follows standard email thread conventions (adding "Re:" if not present)
+        reply_subject = msg.subject if msg.subject.startswith("Re:") else f"Re: {msg.subject}"
+
+        # Construct the reply with the modern EmailMessage API: a single-part HTML
+        # message under the SMTP policy avoids the extra body copies that the old
+        # MIMEMultipart + MIMEText + attach() dance made on every reply
+        mime_msg = EmailMessage(policy=SMTP)
+        mime_msg["To"] = msg.sender
+        mime_msg["From"] = "me"
+        mime_msg["Subject"] = reply_subject
+
+        # Build a case-insensitive view once so each header needs a single lookup
+        # regardless of how the sending client capitalized it
+        headers = CaseInsensitiveDict(msg.headers)
+
+        # Retrieve the original Message-ID from headers to maintain thread integrity
+        original_message_id = headers.get("Message-ID")
+
+        # Fetch existing references to track the entire conversation history
+        references = headers.get("References")
+
+        # Inject threading headers to ensure Gmail and other clients group the reply correctly
+        if original_message_id:
+            # In-Reply-To links this specific reply to the parent message
+            mime_msg["In-Reply-To"] = original_message_id
+
+            # References maintains the chain of all previous Message-IDs in the conversation
+            if references:
+                # Append the current message ID to the existing reference chain
+                mime_msg["References"] = references + " " + original_message_id
+            else:
+                # Start a new reference chain if none exists
+                mime_msg["References"] = original_message_id
+
+        # Set the AI-generated reply body as HTML for rich text rendering:
+        # one translate() pass both escapes the text and converts newlines to <br>
+        html_body = reply_text.translate(HTML_BODY_TBL)
+        mime_msg.set_content(html_body, subtype="html", charset="utf-8")
+
+        # Encode the entire MIME structure into a URL-safe Base64 string for Gmail API compatibility
+        raw_string = base64.urlsafe_b64encode(mime_msg.as_bytes()).decode("ascii")
+
+        # Prepare the API payload consisting of the encoded raw message and the existing threadId
+        raw_payload = {
+            "raw": raw_string,
+            "threadId": msg.thread_id
+        }
+    
+        # Dispatch the reply over the persistent REST session (discovery fallback
+        # inside); the blocking HTTP call runs on a worker thread
+        await asyncio.to_thread(send_gmail_reply, raw_payload)
+        reply_sent = True
+
+        # Mark the original message as read to signify successful processing
+        await asyncio.to_thread(msg.mark_as_read)
+        print("✅ Email successfully replied and marked as READ.")
+
+        # ==============================================================================
+        # TELEGRAM NOTIFICATION SYSTEM
+        # ==============================================================================
+        if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
+            print("⚠️ Warning: Telegram credentials are missing. Skipping notification.")
+            return
+
+        # Fetch the current exact time in WIB for the AI reply timestamp
+        current_time = fmt_wib(int(time.time()))
+
+        # Create a more detailed 500-character snippet for the Telegram report
+        # This ensures the report stays within Telegram's 4096 character limit
+        body_preview = f"{body_cap[:500]}..." if len(body_full) > 500 else body_cap
+
+        # Sanitize dynamic content to prevent Telegram API parsing errors (e.g., Error 400).
+        # This safely escapes special characters like <, >, and & within the email body.
+        safe_sender = html.escape(msg.sender)
+        safe_subject = html.escape(msg.subject)
+        safe_body_escaped = html.escape(body_preview)
+        safe_reply_escaped = html.escape(reply_text)
+
+        # Prepare a well-formatted HTML report for Telegram.
+        # Truncating the original message body to 500 chars to avoid Telegram's 4096 character limit.
+        telegram_report = (
+            f"🚨 <b>NOVAMAIL AI REPORT</b> 🚨\n\n"
+            f"🕒 <b>Received:</b> <code>{received_time_wib}</code>\n"
+            f"👤 <b>From:</b> <code>{safe_sender}</code>\n"
+            f"📌 <b>Subject:</b> {safe_subject}\n\n"
+            f"💬 <b>Original Message:</b>\n{safe_body_escaped}\n\n"
+            f"🤖 <b>AI Reply Sent:</b>\n<i>{safe_reply_escaped}</i>\n\n"
+            f"⏱️ <b>Replied At:</b> <code>{current_time}</code>"
+        )
+
+        # Fire-and-forget: hand the report to the background worker so a slow
+        # Telegram API never blocks the next email. Drop the report if the queue
+        # is full (sustained Telegram outage) rather than growing without bound.
+        try:
+            notify_queue.put_nowait(telegram_report)
+        except queue.Full:
+            print("⚠️ Warning: Notification queue is full. Dropping Telegram report.")
+    except Exception:
+        if not reply_sent:
+            await asyncio.to_thread(release_claim, msg.id)
+        raise
+
+
+async def process_batch(to_reply, superseded):
+    """Run one poll cycle's worth of messages concurrently on the event loop:
+    AI replies for the newest message per thread, plus plain mark-as-read
+    calls for the superseded older siblings."""
+    gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+    # return_exceptions=True isolates failures per message: without it, one
+    # raising handler cancels every sibling mid-flight and their replies are
+    # lost for the cycle. Failed handlers release their claim themselves and
+    # are retried next poll; log them without echoing raw (leaky) details.
+    results = await asyncio.gather(
+        *(asyncio.to_thread(mark_superseded_as_read, m) for m in superseded),
+        *(handle_message(m, gemini_semaphore) for m in to_reply),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            print(f"🚨 A message handler failed ({type(result).__name__}). It will be retried next cycle.")
+
+
+# ==============================================================================
+# ADAPTIVE POLLING CONFIGURATION
+# ==============================================================================
+# Instead of hammering Gmail every 30 seconds even when nothing is happening,
+# the poll interval doubles on every empty cycle (30s -> 60s -> ... -> 300s max)
+# and snaps back to 30 seconds the moment a new email arrives. This removes
+# useless messages.list round trips during quiet hours while keeping reply
+# latency low when the inbox is active.
+POLL_INTERVAL_MIN = 30   # Seconds to wait when the inbox is active
+POLL_INTERVAL_MAX = 300  # Ceiling for the backoff when the inbox stays quiet
+POLL_JITTER_MAX = 5      # Random extra seconds so parallel instances desynchronize
+
+# Graceful shutdown: time.sleep() cannot be interrupted, so the delay below
+# waits on an Event instead. Ctrl+C (or the platform's SIGTERM on redeploy)
+# sets it, which wakes the wait instantly and ends the loop cleanly.
+shutdown_event = threading.Event()
+signal.signal(signal.SIGINT, lambda signum, frame: shutdown_event.set())
+signal.signal(signal.SIGTERM, lambda signum, frame: shutdown_event.set())
+
+print("🎧 NovaMail AI (Adaptive Polling Mode) is listening to your Inbox...")
+
+# ==============================================================================
+# MAIN POLLING LOOP
+# ==============================================================================
+# One event loop lives for the whole program: client.aio's HTTP/2 connection
+# pool binds its connections to the loop they were opened on, so spinning up a
+# fresh loop per batch (asyncio.run inside the polling loop) would hand later
+# bursts stale transports and forfeit the cross-cycle connection reuse.
+async def main():
+    """Poll the inbox until shutdown, processing each batch on this loop."""
+    poll_interval = POLL_INTERVAL_MIN
+
+    while not shutdown_event.is_set():
+        try:
+            # 1. Fetch unread emails (one list call + batched gets, not N+1
+            # RPCs); the blocking Gmail calls run on a worker thread
+            unread_messages = await asyncio.to_thread(fetch_unread_messages)
+
+            if not unread_messages:
+                # Quiet cycle: back off exponentially up to the 5-minute ceiling
+                poll_interval = min(poll_interval * 2, POLL_INTERVAL_MAX)
+                print(f"📭 Inbox is clean. (Checking again in {poll_interval} seconds)")
+            else:
+                # Activity detected: reset to the fastest polling cadence
+                poll_interval = POLL_INTERVAL_MIN
+                # 2. Collapse the burst to one message per thread so busy
+                # conversations get a single reply instead of one per unread
+                newest_per_thread, superseded = dedupe_by_thread(unread_messages)
+
+                # 3. Process the whole batch concurrently: iteration time
+                # drops from the sum of per-email latencies to roughly the
+                # max across the batch
+                await process_batch(newest_per_thread, superseded)
+
+        except Exception as general_error:
+            # SECURE ERROR HANDLING: Do NOT print raw 'general_error' to avoid credential leaks.
+            error_str = str(general_error).lower()
+            if "credentials" in error_str or "token" in error_str:
+                print("🚨 System Error: Authentication failed. Check your token.json or credentials.")
+            else:
+                print(f"🚨 An unexpected system error occurred. Waiting for the next polling cycle to retry -> {error_str}.")
+
+            # Back off on errors too, so a broken credential or API outage is
+            # not hammered at full polling speed
+            poll_interval = min(poll_interval * 2, POLL_INTERVAL_MAX)
+
+        # ==========================================================================
+        # POLLING DELAY
+        # ==========================================================================
+        # Interruptible pause before the next check: the interval adapts to
+        # activity (30 seconds when busy, up to 5 minutes when quiet or
+        # erroring) and the jitter spreads Gmail quota load across parallel
+        # instances. The Event wait runs on a worker thread so the loop stays
+        # responsive, and a shutdown signal wakes it immediately.
+        await asyncio.to_thread(
+            shutdown_event.wait, poll_interval + random.uniform(0, POLL_JITTER_MAX)
+        )
+
+
+asyncio.run(main())
 
-    # ==============================================================================
-    # POLLING DELAY
-    # ==============================================================================
-    # Pause for 30 seconds before checking the inbox again to avoid rate-limiting
-    time.sleep(30)
\ No newline at end of file
+print("👋 NovaMail AI shut down cleanly.")
\ No newline at end of file